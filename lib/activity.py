@@ -0,0 +1,165 @@
+import asyncio
+
+# Rollup periods as (bucket width, shift) in seconds. Buckets are numbered
+# from the epoch; the epoch fell on a Thursday, so weeks are shifted by three
+# days to start on Mondays.
+PERIODS = {
+    'day': (86400, 0),
+    'week': (604800, 259200),
+}
+
+def bucket_of(period, timestamp):
+    width, shift = PERIODS[period]
+    return int((timestamp + shift) // width)
+
+def bucket_start(period, bucket):
+    width, shift = PERIODS[period]
+    return bucket * width - shift
+
+# Raw activity, one row per event: (guild, member, at, session). Each source
+# is read once as seen from its insert trigger and once over a range of ids
+# of its backlog, the history from before the trigger existed.
+#
+# nominations ids are AUTOINCREMENT and never reused, so the table is its own
+# backlog. books_readers only has rowids, which SQLite reuses after deletes and
+# VACUUM renumbers; its history is copied once into a backlog table with ids
+# of its own, which is emptied as the backfill works through it.
+SOURCES = {
+    'books_readers': (
+        'read',
+        'SELECT books.guild AS guild, NEW.reader AS member, NEW.added AS at, NULL AS session \
+         FROM books WHERE books.id = NEW.book',
+        'activity_backlog_reads',
+        'SELECT books.guild AS guild, reader AS member, b.added AS at, NULL AS session \
+         FROM activity_backlog_reads b JOIN books ON books.id = b.book \
+         WHERE b.id > :done AND b.id <= :end',
+        '''
+            CREATE TABLE IF NOT EXISTS activity_backlog_reads(
+                id INTEGER PRIMARY KEY,
+                book INTEGER,
+                reader INTEGER,
+                added REAL
+            );
+            INSERT INTO activity_backlog_reads (book, reader, added)
+                SELECT book, reader, added FROM books_readers
+                WHERE NOT EXISTS (SELECT 1 FROM activity_backfill WHERE source = 'books_readers');
+        ''',
+        'DELETE FROM activity_backlog_reads WHERE id <= :end',
+    ),
+    'nominations': (
+        'nominate',
+        'SELECT sessions.guild AS guild, NEW.nominee AS member, NEW.added AS at, NEW.session AS session \
+         FROM sessions WHERE sessions.id = NEW.session',
+        'nominations',
+        'SELECT sessions.guild AS guild, nominee AS member, added AS at, session \
+         FROM nominations JOIN sessions ON sessions.id = nominations.session \
+         WHERE nominations.id > :done AND nominations.id <= :end',
+        '',
+        None,
+    ),
+}
+
+def _bucketed(events):
+    # Fans every event out to its day and week buckets, plus its session for
+    # events that belong to one. CTEs aren't allowed in triggers, hence the
+    # inline table of periods.
+    periods = ' UNION ALL '.join(
+        f"SELECT '{period}' AS period, {width} AS width, {shift} AS shift"
+        for period, (width, shift) in PERIODS.items()
+    )
+    return f'''
+        SELECT e.guild, p.period, CAST((e.at + p.shift) / p.width AS INTEGER) AS bucket, e.member
+        FROM ({events}) e, ({periods}) p
+        WHERE e.at IS NOT NULL
+        UNION ALL
+        SELECT e.guild, 'session', e.session, e.member
+        FROM ({events}) e
+        WHERE e.session IS NOT NULL
+    '''
+
+def _rollup(kind, events):
+    # Members are only counted the first time they show up in a bucket, which
+    # is why the counters are bumped before activity_members is.
+    bucketed = _bucketed(events)
+    return f'''
+        INSERT INTO activity_rollups (guild, period, bucket, kind, events, members)
+        SELECT guild, period, bucket, '{kind}', count(*), count(DISTINCT CASE WHEN NOT EXISTS (
+                SELECT 1 FROM activity_members m
+                WHERE m.guild = b.guild AND m.period = b.period AND m.bucket = b.bucket
+                    AND m.kind = '{kind}' AND m.member = b.member
+            ) THEN b.member END)
+        FROM ({bucketed}) b
+        WHERE true
+        GROUP BY guild, period, bucket
+        ON CONFLICT (guild, period, bucket, kind) DO UPDATE SET
+            events = events + excluded.events,
+            members = members + excluded.members;
+
+        INSERT OR IGNORE INTO activity_members (guild, period, bucket, kind, member)
+        SELECT guild, period, bucket, '{kind}', member FROM ({bucketed}) b;
+    '''
+
+def _trigger(source, kind, events):
+    return f'''
+        CREATE TRIGGER IF NOT EXISTS {source}_rollup AFTER INSERT ON {source}
+        BEGIN
+            {_rollup(kind, events)}
+        END;
+    '''
+
+# Everything in a source's backlog when its trigger is first created is
+# recorded as the backfill boundary; the trigger counts everything after it.
+# It's all one transaction so the backlog is never copied twice.
+SCHEMA = '''
+    BEGIN;
+    CREATE TABLE IF NOT EXISTS activity_rollups(
+        guild INTEGER,
+        period TEXT,
+        bucket INTEGER,
+        kind TEXT,
+        events INTEGER,
+        members INTEGER,
+        PRIMARY KEY (guild, period, bucket, kind)
+    );
+    CREATE TABLE IF NOT EXISTS activity_members(
+        guild INTEGER,
+        period TEXT,
+        bucket INTEGER,
+        kind TEXT,
+        member INTEGER,
+        PRIMARY KEY (guild, period, bucket, kind, member)
+    );
+    CREATE TABLE IF NOT EXISTS activity_backfill(
+        source TEXT PRIMARY KEY,
+        done INTEGER,
+        upto INTEGER
+    );
+''' + ''.join(
+    snapshot + f'''
+    INSERT OR IGNORE INTO activity_backfill (source, done, upto)
+        SELECT '{source}', 0, coalesce(max(rowid), 0) FROM {backlog};
+    ''' + _trigger(source, kind, events)
+    for source, (kind, events, backlog, _, snapshot, _) in SOURCES.items()
+) + '''
+    COMMIT;
+'''
+
+async def backfill(db, chunk=5000, pause=0.1):
+    # Rolls up history from before the triggers existed, a range of ids at a
+    # time with a commit and a breather in between so commands can interleave.
+    # Progress is checkpointed, so a restart picks up where it left off.
+    for source, (kind, _, _, ranged, _, cleanup) in SOURCES.items():
+        statements = [s for s in _rollup(kind, ranged).split(';') if s.strip()]
+        while True:
+            async with db.execute('SELECT done, upto FROM activity_backfill WHERE source=?', (source,)) as cur:
+                done, upto = await cur.fetchone()
+            if done >= upto:
+                break
+            end = min(done + chunk, upto)
+            for statement in statements:
+                await db.execute(statement, {'done': done, 'end': end})
+            if cleanup:
+                await db.execute(cleanup, {'end': end})
+            await db.execute('UPDATE activity_backfill SET done=? WHERE source=?', (end, source))
+            await db.commit()
+            await asyncio.sleep(pause)
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import re
+import time
+import lib.goodreads as goodreads
+import lib.royalroad as royalroad
+
+log = logging.getLogger(__name__)
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS book_metadata(
+        book INTEGER PRIMARY KEY REFERENCES books(id) ON UPDATE CASCADE ON DELETE CASCADE,
+        status TEXT,
+        source TEXT,
+        url TEXT,
+        title TEXT,
+        authors TEXT,
+        image TEXT,
+        rating TEXT,
+        description TEXT,
+        fetched REAL
+    );
+    CREATE INDEX IF NOT EXISTS book_metadata_idx_status ON book_metadata (status, fetched);
+'''
+
+# Every book gets a row once it has been looked at, whatever the outcome; that
+# row is the checkpoint, so a restarted crawl carries on with the books that
+# don't have one yet. Failed lookups are retried after a while.
+PENDING = '''
+    SELECT id, name FROM books
+    WHERE id NOT IN (
+        SELECT book FROM book_metadata WHERE status != 'error' OR fetched > ?
+    )
+    ORDER BY id
+    LIMIT ?
+'''
+
+def comparable(title):
+    return re.sub(r'[^a-z0-9]+', ' ', title.lower()).strip()
+
+def matches(name, found):
+    # Search results tend to tack the series onto the title, e.g.
+    # "Mother of Learning (Mother of Learning #1)". Anything else has to be
+    # the same title; a wrong match would never be looked at again.
+    found = re.sub(r'\s*\([^()]*#\s*[\d.]+\)\s*$', '', found)
+    return comparable(found) == comparable(name)
+
+async def goodreads_metadata(name, pace):
+    await pace()
+    result = await goodreads.searchBook(name)
+    if not result or not matches(name, result[1]):
+        return None
+    url = result[0]
+    await pace()
+    book = await goodreads.getBook(url)
+    if not book:
+        return None
+    return ('goodreads', url, book.title, ', '.join(author.name for author in book.authors), book.image_link, book.rating, book.description)
+
+async def royalroad_metadata(name, pace):
+    await pace()
+    result = await royalroad.searchBook(name)
+    if not result or not matches(name, result[1]):
+        return None
+    url = "/".join(result[0].split('/')[:6])
+    await pace()
+    book = await royalroad.getBook(url)
+    if not book:
+        return None
+    return ('royalroad', url, book.title, book.author, book.image_link, book.rating, book.description)
+
+SOURCES = [goodreads_metadata, royalroad_metadata]
+
+async def lookup(name, pace):
+    # pace is awaited before every request to either site
+    for source in SOURCES:
+        metadata = await source(name, pace)
+        if metadata:
+            return ('found', *metadata)
+    return ('missing',) + (None,) * 7
+
+class Crawler:
+    # Works through the library in batches, a few books at a time. Requests
+    # are spaced at least delay seconds apart however many books are being
+    # looked up, so the sites aren't hammered. Once caught up it only checks
+    # for new books every idle seconds.
+
+    def __init__(self, db, concurrency=2, delay=2.0, batch=20, idle=600, retry=86400):
+        self.db = db
+        self.concurrency = asyncio.Semaphore(concurrency)
+        self.delay = delay
+        self.pacing = asyncio.Lock()
+        self.next_request = 0.0
+        self.batch = batch
+        self.idle = idle
+        self.retry = retry
+
+    async def run(self):
+        while True:
+            async with self.db.execute(PENDING, (time.time() - self.retry, self.batch)) as cur:
+                pending = await cur.fetchall()
+            if not pending:
+                await asyncio.sleep(self.idle)
+                continue
+
+            results = await asyncio.gather(*(self.enrich(book_id, name) for book_id, name in pending))
+            # Books deleted in the meantime are skipped rather than tripping
+            # the foreign key
+            await self.db.executemany(
+                    'INSERT OR REPLACE INTO book_metadata \
+                        (book, status, source, url, title, authors, image, rating, description, fetched) \
+                     SELECT ?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8, ?9, ?10 \
+                     WHERE EXISTS (SELECT 1 FROM books WHERE id = ?1)',
+                    results,
+            )
+            await self.db.commit()
+
+    async def enrich(self, book_id, name):
+        async with self.concurrency:
+            try:
+                metadata = await lookup(name, self.pace)
+            except Exception:
+                log.exception('Looking up "%s" failed', name)
+                metadata = ('error',) + (None,) * 7
+        return (book_id, *metadata, time.time())
+
+    async def pace(self):
+        async with self.pacing:
+            wait = self.next_request - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.next_request = time.monotonic() + self.delay
@@ -67,3 +67,17 @@ async def getBook(book_url):
             # get book rating
             book.rating = html_soup.find("div", attrs={"class": "RatingStatistics__rating"}).get_text()
             return book
+
+async def searchBook(title):
+    # Returns (link, title) of the first search result, or None if nothing came up
+    async with aiohttp.ClientSession() as session:
+        async with session.get("https://www.goodreads.com/search", params={"q": title}) as response:
+            if(response.status != 200):
+                return;
+
+            page_html = await response.text()
+            html_soup = BeautifulSoup(page_html, 'html.parser')
+
+            for result in html_soup.find_all("a", attrs={"class": "bookTitle"}):
+                # search results carry tracking parameters, the book page doesn't need them
+                return ("https://www.goodreads.com" + result["href"].split("?")[0], result.get_text().strip())
@@ -0,0 +1,132 @@
+import asyncio
+import aiosqlite
+import logging
+import os
+import time
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+class Task:
+    # Runs every interval seconds, and its timings are kept for /maintenance
+    def __init__(self, name, interval, run):
+        self.name = name
+        self.interval = interval
+        self.run = run
+        self.due = time.time() + interval
+        self.runs = 0
+        self.failures = 0
+        self.last_run = None
+        self.last_duration = None
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+
+class Scheduler:
+    # Runs maintenance on its own connection, so commands only ever contend
+    # with it for SQLite's (WAL mode, hence brief) write lock. Due tasks wait
+    # for the bot to be idle for a while, but not beyond a second interval.
+
+    def __init__(self, path, tasks, idle=30, tick=10):
+        self.path = path
+        self.tasks = tasks
+        self.idle = idle
+        self.tick = tick
+        self.last_activity = 0.0
+
+    def touch(self):
+        self.last_activity = time.time()
+
+    async def run(self):
+        async with aiosqlite.connect(self.path) as db:
+            await db.execute('PRAGMA busy_timeout = 5000')
+            while True:
+                await asyncio.sleep(self.tick)
+                for task in self.tasks:
+                    now = time.time()
+                    overdue = now >= task.due + task.interval
+                    if now >= task.due and (overdue or now - self.last_activity >= self.idle):
+                        await self.execute(db, task)
+
+    async def execute(self, db, task):
+        started = time.perf_counter()
+        try:
+            await task.run(db)
+        except Exception:
+            task.failures += 1
+            log.exception('Maintenance task %s failed', task.name)
+        finally:
+            duration = time.perf_counter() - started
+            task.runs += 1
+            task.last_run = time.time()
+            task.last_duration = duration
+            task.total_duration += duration
+            task.max_duration = max(task.max_duration, duration)
+            task.due = task.last_run + task.interval
+            log.info('Maintenance task %s took %.3fs', task.name, duration)
+
+# main returns the bot's own connection. Nothing is committed on it, as that
+# could commit half of whatever command is running; neither statement opens a
+# transaction of its own.
+
+def analyze(main):
+    # The statistics are gathered on this side connection, but the bot's
+    # connection keeps planning with what it loaded at startup until it's told
+    # to reload them
+    async def run(db):
+        await db.execute('ANALYZE')
+        await db.commit()
+        await main().execute('ANALYZE sqlite_schema')
+    return run
+
+def optimize(main):
+    # PRAGMA optimize only looks at the tables queried on the connection it
+    # runs on, which is the bot's rather than this one
+    async def run(db):
+        await main().execute('PRAGMA optimize')
+    return run
+
+async def checkpoint(db):
+    # PASSIVE never waits on readers or writers; whatever it can't copy back
+    # now is picked up next time
+    await db.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+def incremental_vacuum(pages):
+    async def run(db):
+        async with db.execute('PRAGMA auto_vacuum') as cur:
+            mode, = await cur.fetchone()
+        if mode != 2:
+            # Only databases created (or VACUUMed) with auto_vacuum set to
+            # INCREMENTAL keep the free-list this needs
+            return
+        # Every step of the pragma frees a single page and execute() only
+        # takes the first one; a script steps it to the end
+        await db.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+    return run
+
+def backup(directory, keep, pages=256):
+    async def run(db):
+        os.makedirs(directory, exist_ok=True)
+        name = datetime.now().strftime('librarycard-%Y%m%d-%H%M%S.sqlite3')
+        target = os.path.join(directory, name)
+        partial = target + '.part'
+        # Copying a few pages at a time lets writers in between steps; the
+        # snapshot is only given its real name once it's complete
+        try:
+            async with aiosqlite.connect(partial) as snapshot:
+                await db.backup(snapshot, pages=pages, sleep=0.05)
+            os.replace(partial, target)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+        snapshots = sorted(
+            entry for entry in os.listdir(directory)
+            if entry.startswith('librarycard-') and entry.endswith('.sqlite3')
+        )
+        for old in snapshots[:-keep]:
+            os.remove(os.path.join(directory, old))
+        # Left behind if the bot died halfway through a backup
+        for entry in os.listdir(directory):
+            if entry.startswith('librarycard-') and entry.endswith('.sqlite3.part'):
+                os.remove(os.path.join(directory, entry))
+    return run
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import numpy as np
+from scipy import sparse
+
+log = logging.getLogger(__name__)
+
+class Model:
+    def __init__(self, book_ids, similarity, popularity):
+        self.book_ids = book_ids
+        self.index = {int(book): i for i, book in enumerate(book_ids)}
+        self.similarity = similarity
+        self.popularity = popularity
+
+    def recommend(self, read_ids, count):
+        read = [self.index[book] for book in read_ids if book in self.index]
+        if read:
+            # Every unread book scores the summed cosine similarity to what
+            # the reader already hoarded
+            scores = np.asarray(self.similarity[read].sum(axis=0)).ravel()
+        else:
+            scores = np.zeros(len(self.book_ids))
+        scores[read] = -np.inf
+        if not (scores > 0).any():
+            # Nothing to go on (new reader, or only books they already read or
+            # nobody else did); the most hoarded books are as good a guess as any
+            scores = self.popularity.astype(np.float64)
+            scores[read] = -np.inf
+
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > count:
+            top = np.argpartition(-scores[candidates], count - 1)[:count]
+            candidates = candidates[top]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return [(int(self.book_ids[i]), float(scores[i])) for i in candidates]
+
+def build(pairs, neighbours):
+    # pairs is (reader, book) for every hoarded book in the guild. This is the
+    # heavy lifting; run it in an executor, not on the event loop.
+    if not pairs:
+        return Model(np.zeros(0, dtype=np.int64), sparse.csr_matrix((0, 0)), np.zeros(0))
+
+    readers, books = np.array(pairs, dtype=np.int64).T
+    reader_ids, rows = np.unique(readers, return_inverse=True)
+    book_ids, cols = np.unique(books, return_inverse=True)
+    hoards = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+        shape=(len(reader_ids), len(book_ids)),
+    )
+
+    # Co-reading counts; the diagonal is how many readers hoarded each book
+    co = (hoards.T @ hoards).tocsr()
+    popularity = co.diagonal()
+    co.setdiag(0)
+    co.eliminate_zeros()
+    norms = sparse.diags(1 / np.sqrt(np.maximum(popularity, 1)))
+    similarity = (norms @ co @ norms).tocsr()
+
+    return Model(book_ids, prune(similarity, neighbours), popularity)
+
+def prune(similarity, neighbours):
+    # Only the strongest neighbours of each book are kept, which bounds both
+    # the memory of popular guilds and the cost of scoring a reader
+    indptr, indices, data = [0], [], []
+    for row in range(similarity.shape[0]):
+        start, end = similarity.indptr[row], similarity.indptr[row + 1]
+        row_data = similarity.data[start:end]
+        row_indices = similarity.indices[start:end]
+        if len(row_data) > neighbours:
+            keep = np.argpartition(-row_data, neighbours - 1)[:neighbours]
+            row_data = row_data[keep]
+            row_indices = row_indices[keep]
+        data.append(row_data)
+        indices.append(row_indices)
+        indptr.append(indptr[-1] + len(row_data))
+    return sparse.csr_matrix(
+        (np.concatenate(data), np.concatenate(indices), np.array(indptr)),
+        shape=similarity.shape,
+    )
+
+class Recommender:
+    # Keeps one model per guild. Reads are only counted as they come in; once
+    # a guild has seen enough of them its model is rebuilt in the background
+    # while recommendations keep being served from the previous one.
+
+    def __init__(self, load, rebuild_after=25, neighbours=50):
+        self.load = load
+        self.rebuild_after = rebuild_after
+        self.neighbours = neighbours
+        self.models = {}
+        self.pending = {}
+        self.builds = {}
+
+    async def model(self, guild_id):
+        model = self.models.get(guild_id)
+        if model is None:
+            model = await self.rebuild(guild_id)
+        return model
+
+    def record(self, guild_id, reads=1):
+        if guild_id not in self.models:
+            return
+        self.pending[guild_id] = self.pending.get(guild_id, 0) + reads
+        if self.pending[guild_id] >= self.rebuild_after:
+            self.rebuild(guild_id)
+
+    def rebuild(self, guild_id):
+        build = self.builds.get(guild_id)
+        if build is None:
+            build = self.builds[guild_id] = asyncio.create_task(self._rebuild(guild_id))
+            build.add_done_callback(lambda task: self._built(guild_id, task))
+        return build
+
+    async def _rebuild(self, guild_id):
+        # Reads recorded while this runs may or may not make it in, so they
+        # stay pending; so do all of them if the build fails
+        reads = self.pending.get(guild_id, 0)
+        try:
+            pairs = await self.load(guild_id)
+            model = await asyncio.get_running_loop().run_in_executor(None, build, pairs, self.neighbours)
+        finally:
+            del self.builds[guild_id]
+        self.models[guild_id] = model
+        self.pending[guild_id] = self.pending.get(guild_id, 0) - reads
+        return model
+
+    def _built(self, guild_id, task):
+        # Background rebuilds have nobody awaiting them to see a failure
+        if not task.cancelled() and task.exception() is not None:
+            log.error('Rebuilding recommendations for guild %s failed', guild_id, exc_info=task.exception())
@@ -86,3 +86,17 @@ async def getBook(book_url):
             # get book rating
             book.rating = html_soup.find("meta", attrs={"property": "books:rating:value"})["content"]
             return book
+
+async def searchBook(title):
+    # Returns (link, title) of the first search result, or None if nothing came up
+    async with aiohttp.ClientSession() as session:
+        async with session.get("https://www.royalroad.com/fictions/search", params={"title": title}) as response:
+            if(response.status != 200):
+                return;
+
+            page_html = await response.text()
+            html_soup = BeautifulSoup(page_html, 'html.parser')
+
+            for result in html_soup.find_all("h2", attrs={"class": "fiction-title"}):
+                link = result.find("a")
+                return (urlToAbsolute(link["href"]), link.get_text().strip())
@@ -0,0 +1,79 @@
+import asyncio
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+
+log = logging.getLogger(__name__)
+
+class Stall:
+    def __init__(self, handler, stack):
+        self.started = time.time()
+        self.handler = handler
+        self.stack = stack
+        self.duration = None
+
+class Watchdog:
+    # A heartbeat on the event loop measures how late its sleeps wake up. A
+    # thread of its own watches that heartbeat, and when it stops for longer
+    # than threshold seconds, samples the loop thread's stack to find out who
+    # is hogging it. handlers maps the code objects of commands and events to
+    # names, so the stall can be blamed on the one the stack passes through.
+
+    def __init__(self, interval=0.1, threshold=0.5, keep=20, samples=1000):
+        self.interval = interval
+        self.threshold = threshold
+        self.handlers = {}
+        self.lags = collections.deque(maxlen=samples)
+        self.stalls = collections.deque(maxlen=keep)
+        self.beat = time.monotonic()
+        self.stall = None
+        self.loop_thread = None
+
+    async def run(self):
+        # Must run on the loop being watched
+        self.loop_thread = threading.get_ident()
+        self.beat = time.monotonic()
+        threading.Thread(target=self.watch, name='watchdog', daemon=True).start()
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.beat = time.monotonic()
+            lag = self.beat - started - self.interval
+            self.lags.append(lag)
+
+            stall, self.stall = self.stall, None
+            if stall is not None:
+                stall.duration = lag
+                self.stalls.append(stall)
+                log.warning('Event loop blocked for %.3fs in %s:\n%s', lag, stall.handler, ''.join(stall.stack))
+
+    def watch(self):
+        while True:
+            time.sleep(self.interval)
+            beat = self.beat
+            late = time.monotonic() - beat - self.interval
+            if late > self.threshold and self.stall is None:
+                frame = sys._current_frames().get(self.loop_thread)
+                if frame is not None:
+                    stall = Stall(self.blame(frame), traceback.format_stack(frame))
+                    # Don't pin a stall on a heartbeat that already got through
+                    if self.beat == beat:
+                        self.stall = stall
+
+    def blame(self, frame):
+        # Running coroutines are chained through f_back, so the handler that
+        # awaited its way down to the blocking call is on the way up
+        culprit = None
+        while frame is not None:
+            culprit = self.handlers.get(frame.f_code, culprit)
+            frame = frame.f_back
+        return culprit or 'unknown'
+
+    def percentile(self, p):
+        if not self.lags:
+            return 0.0
+        lags = sorted(self.lags)
+        return lags[min(len(lags) - 1, int(len(lags) * p / 100))]
@@ -2,12 +2,19 @@ import random
 import discord
 import contextvars
 import itertools
+import json
 import lib.goodreads as goodreads
 import lib.royalroad as royalroad
+import lib.recommend as recommend
+import lib.activity as activity
+import lib.maintenance as maintenance
+import lib.enrichment as enrichment
+import lib.watchdog as watchdog
 import os
 import re
 import asyncio
 import aiosqlite
+import logging
 import time
 from dotenv import load_dotenv
 import typing
@@ -23,25 +30,137 @@ from discord import guild_only
 
 load_dotenv()
 
+log = logging.getLogger('librarycard')
+
 pagination = int(os.environ.get('PAGINATION', 10))
 
+# Bump whenever getGoodreadsBook or getRoyalRoadBook change what they render,
+# so previews cached with the old layout are rebuilt instead of reused
+EMBED_VERSION = 1
+preview_ttl = float(os.environ.get('PREVIEW_CACHE_HOURS', 24)) * 3600
+
 db = contextvars.ContextVar('db')
 
+async def hoarded_pairs(guild_id):
+    async with db.get().execute(
+            'SELECT reader, book FROM books_readers JOIN books ON books.id = books_readers.book WHERE guild=?',
+            (guild_id,),
+            ) as cursor:
+        return await cursor.fetchall()
+
+recommender = recommend.Recommender(
+    hoarded_pairs,
+    rebuild_after=int(os.environ.get('RECOMMEND_REBUILD_AFTER', 25)),
+    neighbours=int(os.environ.get('RECOMMEND_NEIGHBOURS', 50)),
+)
+
+class GuildState:
+    # Write-through cache of the lookups nearly every command starts with.
+    # Anything that changes sessions or books updates it right after its
+    # commit; a cold guild is loaded from SQLite on first use. The generation
+    # is bumped on every write so a load that raced one is thrown away rather
+    # than caching what it read before the write landed.
+    UNKNOWN = object()
+
+    def __init__(self):
+        self.session = GuildState.UNKNOWN
+        self.books = None
+        self.generation = 0
+
+    def touch(self):
+        self.generation += 1
+
+guild_states = {}
+
+def guild_state(guild_id):
+    state = guild_states.get(guild_id)
+    if state is None:
+        state = guild_states[guild_id] = GuildState()
+    return state
+
 async def current_session(guild_id):
+    state = guild_state(guild_id)
+    if state.session is not GuildState.UNKNOWN:
+        return state.session
+
+    generation = state.generation
     async with db.get().execute(
             'SELECT id FROM sessions WHERE guild=? AND NOT ended LIMIT 1', (guild_id,)
             ) as cursor:
         result = await cursor.fetchone()
-    if result is None:
-        return None
-    return result[0]
+    session = None if result is None else result[0]
+    if state.generation == generation:
+        state.session = session
+    return session
+
+async def book_id_by_name(guild_id, book):
+    state = guild_state(guild_id)
+    if state.books is None:
+        generation = state.generation
+        async with db.get().execute('SELECT name, id FROM books WHERE guild=?', (guild_id,)) as cursor:
+            books = dict(await cursor.fetchall())
+        if state.generation != generation:
+            return books.get(book)
+        state.books = books
+    return state.books.get(book)
+
+def cache_session(guild_id, session):
+    state = guild_state(guild_id)
+    state.touch()
+    state.session = session
+
+def cache_book(guild_id, book, book_id):
+    state = guild_state(guild_id)
+    state.touch()
+    if state.books is not None:
+        state.books[book] = book_id
+
+def uncache_book(guild_id, book):
+    state = guild_state(guild_id)
+    state.touch()
+    if state.books is not None:
+        state.books.pop(book, None)
+
+# Per-session nomination counts for the most recent sessions of a guild (bound
+# parameters: guild, number of sessions). The active session is counted in
+# nomination_tallies, ended ones were frozen into nomination_archive; a session
+# only ever lives in one of the two, so callers can simply sum the votes.
+TALLIES_QUERY = '''
+    WITH recent AS (
+        SELECT id FROM sessions WHERE guild = ? ORDER BY startedAt DESC LIMIT ?
+    )
+    SELECT name, votes FROM nomination_tallies WHERE session IN recent
+    UNION ALL
+    SELECT name, votes FROM nomination_archive WHERE session IN recent
+'''
+
+async def backfill_nomination_tallies():
+    # Databases from before the tallies existed (or fresh out of the Mongo
+    # migration) only have raw nominations. Only sessions without any
+    # precomputed rows are touched, so this is cheap once caught up.
+    await db.get().executescript('''
+        INSERT INTO nomination_archive (session, name, votes)
+        SELECT session, name, count(nominee) FROM nominations
+        WHERE session IN (
+            SELECT id FROM sessions
+            WHERE ended AND id NOT IN (SELECT session FROM nomination_archive)
+        )
+        GROUP BY session, name;
 
-async def book_id_by_name(book):
-    async with db.get().execute('SELECT id FROM books WHERE name=? LIMIT 1', (book,)) as cursor:
-        result = await cursor.fetchone()
-    if result is None:
-        return None
-    return result[0]
+        INSERT INTO nomination_tallies (session, name, votes)
+        SELECT session, name, count(nominee) FROM nominations
+        WHERE session IN (
+            SELECT id FROM sessions
+            WHERE NOT ended AND id NOT IN (SELECT session FROM nomination_tallies)
+        )
+        GROUP BY session, name;
+    ''')
+
+def describe_metadata(url, authors):
+    # Whatever the enrichment crawler found out about a book, for listings
+    if not url:
+        return ''
+    return f'\nBy {authors} ([details]({url}))'
 
 def into_paginated_embed(rows, make_embed, add_datum, enumerates=False):
     pages = []
@@ -60,6 +179,26 @@ def into_paginated_embed(rows, make_embed, add_datum, enumerates=False):
         offset += pagination
     return Paginator(pages=pages)
 
+HOUR = 3600
+
+maintenance_tasks = [
+    maintenance.Task('optimize', 6 * HOUR, maintenance.optimize(db.get)),
+    maintenance.Task('analyze', 24 * HOUR, maintenance.analyze(db.get)),
+    maintenance.Task('checkpoint', HOUR / 4, maintenance.checkpoint),
+    maintenance.Task('incremental-vacuum', 24 * HOUR, maintenance.incremental_vacuum(pages=1024)),
+]
+if os.environ.get('BACKUP_DIR'):
+    maintenance_tasks.append(maintenance.Task(
+        'backup',
+        float(os.environ.get('BACKUP_INTERVAL_HOURS', 24)) * HOUR,
+        maintenance.backup(os.environ['BACKUP_DIR'], keep=int(os.environ.get('BACKUP_KEEP', 7))),
+    ))
+maintainer = maintenance.Scheduler(os.environ.get('SQLITE3_DATABASE'), maintenance_tasks)
+
+# Discord fails interactions that aren't answered within three seconds, so
+# anything holding the loop for a good fraction of that is worth knowing about
+loop_watchdog = watchdog.Watchdog(threshold=float(os.environ.get('WATCHDOG_THRESHOLD_MS', 500)) / 1000)
+
 intents = discord.Intents.default()
 intents.message_content = True
 bot = discord.Bot(intents=intents)
@@ -89,7 +228,7 @@ async def addBook(ctx, book: str):
     book = unsmarten(book)
 
     try:
-        await db.get().execute('INSERT INTO books (guild, added, addedBy, name) VALUES (?, ?, ?, ?)',
+        cur = await db.get().execute('INSERT INTO books (guild, added, addedBy, name) VALUES (?, ?, ?, ?)',
                    (ctx.guild_id, time.time(), ctx.author.id, book),
         )
         await db.get().commit()
@@ -99,6 +238,7 @@ async def addBook(ctx, book: str):
         else:
             raise
     else:
+        cache_book(ctx.guild_id, book, cur.lastrowid)
         await ctx.respond(f'***{book}*** added to library')
 
 @bot.slash_command(name="delbook", description = "Remove a book from your Flight's library")
@@ -109,11 +249,13 @@ async def delBook(ctx, book: str):
     book = unsmarten(book)
 
     async with db.get().execute('DELETE FROM books WHERE name=? AND guild=?', (book, ctx.guild_id)) as cur:
-        if cur.rowcount:
-            await ctx.respond('Book deleted')
-        else:
-            await ctx.respond('Book not found')
+        deleted = cur.rowcount
     await db.get().commit()
+    if deleted:
+        uncache_book(ctx.guild_id, book)
+        await ctx.respond('Book deleted')
+    else:
+        await ctx.respond('Book not found')
 
 @bot.slash_command(name="delbookbyid", description = "Remove a book from your Flight's library")
 @guild_only()
@@ -125,18 +267,23 @@ async def delBookById(ctx, id: str):
         await ctx.respond(f'"{id}" is not a valid integer.')
         return
 
-    async with db.get().execute('DELETE FROM books WHERE id=? AND guild=?', (id, ctx.guild_id)) as cur:
-        if cur.rowcount:
-            await ctx.respond('Book deleted')
-        else:
-            await ctx.respond('No such book')
+    async with db.get().execute('DELETE FROM books WHERE id=? AND guild=? RETURNING name', (id, ctx.guild_id)) as cur:
+        deleted = await cur.fetchone()
     await db.get().commit()
+    if deleted:
+        uncache_book(ctx.guild_id, deleted[0])
+        await ctx.respond('Book deleted')
+    else:
+        await ctx.respond('No such book')
 
 @bot.slash_command(name="library", description = "List all the book in your Flight's library")
 @guild_only()
 async def library(ctx):
     async with db.get().execute(
-            'SELECT name, count(reader) FROM books JOIN books_readers ON books.id = books_readers.book WHERE guild=? GROUP BY books.id',
+            "SELECT name, count(reader), url, authors \
+             FROM books JOIN books_readers ON books.id = books_readers.book \
+                LEFT JOIN book_metadata ON books.id = book_metadata.book AND status = 'found' \
+             WHERE guild=? GROUP BY books.id",
             (ctx.guild_id,),
             ) as cur:
         results = await cur.fetchall()
@@ -150,8 +297,8 @@ async def library(ctx):
             title='Book listing',
             description=f'{total} books in the library.',
         ),
-        lambda embed, name, readers: \
-                embed.add_field(name=name, value=f'Readers: {readers}', inline=False),
+        lambda embed, name, readers, url, authors: \
+                embed.add_field(name=name, value=f'Readers: {readers}' + describe_metadata(url, authors), inline=False),
     )
     await pagination.respond(ctx.interaction, ephemeral=True)
 
@@ -178,12 +325,122 @@ async def unopened(ctx):
     await pagination.respond(ctx.interaction, ephemeral=True)
 
 
+# Several titles can be given at once, separated by this. Titles may contain
+# it too, so the whole input is tried as a single title first; such a title
+# just can't be part of a list.
+TITLE_SEPARATOR = ';'
+TITLES_DESCRIPTION = f"Book title, or several split by '{TITLE_SEPARATOR}' (titles with '{TITLE_SEPARATOR}' go alone); leave out for a list"
+
+async def split_titles(guild_id, books):
+    whole = unsmarten(books.strip())
+    if await book_id_by_name(guild_id, whole) is not None:
+        return [whole]
+
+    titles = []
+    for title in books.split(TITLE_SEPARATOR):
+        title = unsmarten(title.strip())
+        if title and title not in titles:
+            titles.append(title)
+    return titles
+
+async def hoard_status(guild_id, reader, titles):
+    # Resolves all titles at once, along with whether the reader already
+    # hoarded them. Titles that don't come back aren't in the library.
+    async with db.get().execute(
+            f'SELECT name, books.id, books_readers.reader IS NOT NULL \
+             FROM books LEFT JOIN books_readers ON books.id = books_readers.book AND reader=? \
+             WHERE guild=? AND name IN ({",".join("?" * len(titles))})',
+            (reader, guild_id, *titles),
+            ) as cur:
+        return {name: (book_id, hoarded) async for name, book_id, hoarded in cur}
+
+def summarize(groups):
+    lines = [f'{label}: {", ".join(titles)}' for label, titles in groups if titles]
+    summary = '\n'.join(lines)
+    if len(summary) > 2000:
+        summary = '\n'.join(f'{label}: {len(titles)} books' for label, titles in groups if titles)
+    return summary
+
+async def read_books(guild_id, reader, titles):
+    status = await hoard_status(guild_id, reader, titles)
+    added = [title for title in titles if title in status and not status[title][1]]
+    if added:
+        now = time.time()
+        await db.get().executemany(
+                'INSERT OR IGNORE INTO books_readers (book, reader, added) VALUES (?, ?, ?)',
+                [(status[title][0], reader, now) for title in added],
+        )
+        await db.get().commit()
+        recommender.record(guild_id, len(added))
+    return summarize([
+        ('Added to hoard', added),
+        ('Already hoarded', [title for title in titles if title in status and status[title][1]]),
+        ('Not found', [title for title in titles if title not in status]),
+    ])
+
+async def forget_books(guild_id, reader, titles):
+    status = await hoard_status(guild_id, reader, titles)
+    forgotten = [title for title in titles if title in status and status[title][1]]
+    if forgotten:
+        await db.get().executemany(
+                'DELETE FROM books_readers WHERE reader=? AND book=?',
+                [(reader, status[title][0]) for title in forgotten],
+        )
+        await db.get().commit()
+        recommender.record(guild_id, len(forgotten))
+    return summarize([
+        ('Forgot about', forgotten),
+        ('Not in your hoard', [title for title in titles if title in status and not status[title][1]]),
+        ('Not found', [title for title in titles if title not in status]),
+    ])
+
+def book_picker(placeholder, titles, pick):
+    # Select menus are capped at 25 options and 100 character labels; the
+    # picked titles are passed on in full
+    select = discord.ui.Select(
+        placeholder=placeholder,
+        max_values=len(titles),
+        options=[discord.SelectOption(label=title[:100], value=str(idx)) for idx, title in enumerate(titles)],
+    )
+
+    async def callback(interaction):
+        picked = [titles[int(value)] for value in select.values]
+        await interaction.response.edit_message(content=await pick(picked), view=None)
+
+    select.callback = callback
+    return discord.ui.View(select)
+
+async def pick_books(ctx, query, placeholder, empty, pick):
+    # query is bound to (reader, guild) and returns at most 25 titles
+    async with db.get().execute(query, (ctx.author.id, ctx.guild_id)) as cur:
+        titles = [row[0] for row in await cur.fetchall()]
+    if not titles:
+        await ctx.respond(empty, ephemeral=True)
+        return
+    await ctx.respond(view=book_picker(placeholder, titles, pick), ephemeral=True)
+
 @bot.slash_command(name="readbook", description="Read a book and add it to your hoard")
 @guild_only()
-async def readBook(ctx, book: str):
-    book = unsmarten(book)
+async def readBook(ctx, book: Option(str, TITLES_DESCRIPTION, required=False, default=None)):
+    if book is None:
+        await pick_books(ctx,
+            'SELECT name FROM books WHERE NOT EXISTS ( \
+                SELECT 1 FROM books_readers WHERE book = books.id AND reader=? \
+             ) AND guild=? \
+             ORDER BY books.added DESC LIMIT 25',
+            'Books you read',
+            'You\'ve read it all',
+            lambda titles: read_books(ctx.guild_id, ctx.author.id, titles),
+        )
+        return
+
+    titles = await split_titles(ctx.guild_id, book)
+    if len(titles) > 1:
+        await ctx.respond(await read_books(ctx.guild_id, ctx.author.id, titles))
+        return
+    book = titles[0] if titles else ''
 
-    book_id = await book_id_by_name(book)
+    book_id = await book_id_by_name(ctx.guild_id, book)
     if book_id is None:
         await ctx.respond('Book not found', ephemeral=True)
         return
@@ -194,36 +451,56 @@ async def readBook(ctx, book: str):
         )
         await db.get().commit()
     except aiosqlite.IntegrityError as e:
-        if e.args[0] == 'UNIQUE constraint failed: book_readers.book, book_readers.reader':
+        if e.args[0] == 'UNIQUE constraint failed: books_readers.book, books_readers.reader':
             await ctx.respond('Already hoarded this book', ephemeral=True)
             return
         else:
             raise
     else:
+        recommender.record(ctx.guild_id)
         await ctx.respond(f'{book} added to hoard')
 
 @bot.slash_command(name="forgetbook", description="Forget about a book and remove it from your hoard")
 @guild_only()
-async def forgetBook(ctx, book:str):
-    book = unsmarten(book)
+async def forgetBook(ctx, book: Option(str, TITLES_DESCRIPTION, required=False, default=None)):
+    if book is None:
+        await pick_books(ctx,
+            'SELECT name FROM books JOIN books_readers ON books.id = books_readers.book \
+             WHERE reader=? AND guild=? \
+             ORDER BY books_readers.added DESC LIMIT 25',
+            'Books to forget',
+            'You have nothing to forget',
+            lambda titles: forget_books(ctx.guild_id, ctx.author.id, titles),
+        )
+        return
 
-    async with db.get().execute('SELECT book FROM books_readers WHERE reader=?', (ctx.author.id,)) as cur:
-        result = await cur.fetchone()
-    if result is None:
-        await ctx.respond('You have nothing to forget')
+    titles = await split_titles(ctx.guild_id, book)
+    if len(titles) > 1:
+        await ctx.respond(await forget_books(ctx.guild_id, ctx.author.id, titles))
         return
+    book = titles[0] if titles else ''
 
-    book_id = await book_id_by_name(book)
+    book_id = await book_id_by_name(ctx.guild_id, book)
     if book_id is None:
         await ctx.respond('Book not found', ephemeral=True)
         return
 
     async with db.get().execute('DELETE FROM books_readers WHERE reader=? AND book=?', (ctx.author.id, book_id)) as cur:
-        if cur.rowcount:
-            await ctx.respond('You forgot about ' + book)
-        else:
-            await ctx.respond('You\'re bad at forgetting')
+        forgotten = cur.rowcount
     await db.get().commit()
+    if forgotten:
+        recommender.record(ctx.guild_id)
+        await ctx.respond('You forgot about ' + book)
+        return
+
+    # Only the miss needs to tell an empty hoard apart from a book that just
+    # isn't in it
+    async with db.get().execute('SELECT book FROM books_readers WHERE reader=? LIMIT 1', (ctx.author.id,)) as cur:
+        result = await cur.fetchone()
+    if result is None:
+        await ctx.respond('You have nothing to forget')
+    else:
+        await ctx.respond('You\'re bad at forgetting')
 
 @bot.slash_command(name="hoard", description="Check out your (or a wingmate's) hoard")
 @guild_only()
@@ -240,10 +517,12 @@ async def hoard(ctx, user: typing.Optional[discord.Member]):
         ephem = False
 
     async with db.get().execute(
-            'SELECT name, \
-                    books_readers.added AS time\
+            "SELECT name, \
+                    books_readers.added AS time, \
+                    url, authors \
              FROM books JOIN books_readers ON books.id = books_readers.book \
-             WHERE reader = ?',
+                LEFT JOIN book_metadata ON books.id = book_metadata.book AND status = 'found' \
+             WHERE reader = ?",
              (userid,)
              ) as cur:
         results = await cur.fetchall()
@@ -256,11 +535,51 @@ async def hoard(ctx, user: typing.Optional[discord.Member]):
             title='Book Hoard',
             description=f"{len(results)} books in {username}'s hoard",
         ),
-        lambda embed, name, time: \
-            embed.add_field(name=name, value=f'Hoarded <t:{round(time)}:f>', inline=False),
+        lambda embed, name, time, url, authors: \
+            embed.add_field(name=name, value=f'Hoarded <t:{round(time)}:f>' + describe_metadata(url, authors), inline=False),
     )
     await pagination.respond(ctx.interaction, ephemeral=ephem)
 
+@bot.slash_command(name="recommend", description="Find unread books that readers like you have hoarded")
+@guild_only()
+async def recommendBooks(ctx, count: Option(int, "How many books to suggest.", min_value=1, max_value=50, default=10)):
+    if ctx.guild_id not in recommender.models:
+        # The first call after a restart builds the guild's model, which for
+        # a big library takes longer than Discord waits for an answer
+        await ctx.defer(ephemeral=True)
+    model = await recommender.model(ctx.guild_id)
+
+    async with db.get().execute(
+            'SELECT book FROM books_readers JOIN books ON books.id = books_readers.book WHERE reader=? AND guild=?',
+            (ctx.author.id, ctx.guild_id),
+            ) as cur:
+        read_ids = [row[0] for row in await cur.fetchall()]
+
+    suggestions = dict(model.recommend(read_ids, count))
+    results = []
+    if suggestions:
+        # Books deleted since the model was built simply drop out here
+        async with db.get().execute(
+                f'SELECT id, name FROM books WHERE guild=? AND id IN ({",".join("?" * len(suggestions))})',
+                (ctx.guild_id, *suggestions),
+                ) as cur:
+            names = dict(await cur.fetchall())
+        results = [(names[book],) for book in suggestions if book in names]
+    if not results:
+        await ctx.respond('Nothing to recommend yet, go read something!', ephemeral=True)
+        return
+
+    pagination = into_paginated_embed(results,
+        lambda _: discord.Embed(
+            title='Recommended reading',
+            description=f'{len(results)} books hoarded by readers like you.',
+        ),
+        lambda embed, idx, name: \
+                embed.add_field(name=f'{idx+1}: {name}', value='', inline=False),
+        enumerates=True,
+    )
+    await pagination.respond(ctx.interaction, ephemeral=True)
+
 @bot.slash_command(name="leaderboard", description="See who's hoard is the biggest")
 @guild_only()
 async def leaderboard(ctx):
@@ -289,6 +608,64 @@ async def leaderboard(ctx):
     )
     await pagination.respond(ctx.interaction)
 
+@bot.slash_command(name="stats", description="See your Flight's reading activity over time")
+@guild_only()
+async def stats(
+  ctx,
+  period: Option(str, "How to group the activity.", choices=list(activity.PERIODS), default='week'),
+  span: Option(int, "How many periods to look back over.", min_value=1, max_value=60, default=12),
+  past_sessions: Option(int, "How many sessions to show participation for.", min_value=0, max_value=10, default=3)):
+    last = activity.bucket_of(period, time.time())
+    first = last - span + 1
+    async with db.get().execute(
+            'SELECT bucket, kind, events, members FROM activity_rollups \
+             WHERE guild=? AND period=? AND bucket BETWEEN ? AND ?',
+            (ctx.guild_id, period, first, last),
+            ) as cur:
+        buckets = {}
+        async for bucket, kind, events, members in cur:
+            buckets.setdefault(bucket, {})[kind] = (events, members)
+
+    async with db.get().execute(
+            "SELECT startedAt, coalesce(events, 0), coalesce(members, 0) \
+             FROM sessions LEFT JOIN activity_rollups \
+                ON activity_rollups.guild = sessions.guild AND period = 'session' AND bucket = sessions.id AND kind = 'nominate' \
+             WHERE sessions.guild=? \
+             ORDER BY startedAt DESC \
+             LIMIT ?",
+            (ctx.guild_id, past_sessions),
+            ) as cur:
+        sessions = await cur.fetchall()
+
+    if not buckets and not sessions:
+        await ctx.respond('No activity to report yet.', ephemeral=True)
+        return
+
+    results = []
+    for bucket in range(last, first - 1, -1):
+        reads, readers = buckets.get(bucket, {}).get('read', (0, 0))
+        nominations, nominators = buckets.get(bucket, {}).get('nominate', (0, 0))
+        results.append((activity.bucket_start(period, bucket), reads, readers, nominations, nominators))
+
+    total_reads = sum(row[1] for row in results)
+    summary = [f'{total_reads} books read over the last {span} {period}s.']
+    for started, nominations, nominators in sessions:
+        summary.append(f'Session of <t:{round(started)}:d>: {nominations} nominations from {nominators} members')
+
+    pagination = into_paginated_embed(results,
+        lambda _: discord.Embed(
+            title='Reading activity',
+            description='\n'.join(summary),
+        ),
+        lambda embed, start, reads, readers, nominations, nominators: \
+                embed.add_field(
+                    name='',
+                    value=f'**<t:{start}:D>**\nRead {reads} books by {readers} readers\nNominated {nominations} books by {nominators} members',
+                    inline=False,
+                ),
+    )
+    await pagination.respond(ctx.interaction, ephemeral=True)
+
 @bot.slash_command(name="start-session", description = "Starts a new reading session for your Flight")
 @guild_only()
 @default_permissions(manage_messages=True)
@@ -297,11 +674,12 @@ async def startSession(ctx):
         await ctx.respond('Your flight already have an active reading session.')
         return
 
-    await db.get().execute(
+    cur = await db.get().execute(
             'INSERT INTO sessions (guild, startedBy, startedAt) VALUES (?, ?, ?)',
             (ctx.guild_id, ctx.author.id, time.time()),
     )
     await db.get().commit()
+    cache_session(ctx.guild_id, cur.lastrowid)
 
     await ctx.respond(f'<@{ctx.author.id}> started a new reading session.')
 
@@ -309,7 +687,8 @@ async def startSession(ctx):
 @guild_only()
 @default_permissions(manage_messages=True)
 async def endSession(ctx):
-    if (await current_session(ctx.guild_id)) is None:
+    session = await current_session(ctx.guild_id)
+    if session is None:
         await ctx.respond('Your flight doesn\'t have an active reading session.')
         return
 
@@ -317,7 +696,16 @@ async def endSession(ctx):
             'UPDATE sessions SET ended=1, endedBy=?, endedAt=? WHERE guild=? AND NOT ended',
             (ctx.author.id, time.time(), ctx.guild_id),
     )
+    # Freeze the running tallies; ended sessions never receive nominations
+    # again, so the archive is all the listings need from here on.
+    await db.get().execute(
+            'INSERT INTO nomination_archive (session, name, votes) \
+             SELECT session, name, votes FROM nomination_tallies WHERE session=?',
+            (session,),
+    )
+    await db.get().execute('DELETE FROM nomination_tallies WHERE session=?', (session,))
     await db.get().commit()
+    cache_session(ctx.guild_id, None)
 
     await ctx.respond('The current session has ended')
 
@@ -332,7 +720,7 @@ async def addNomination(ctx, book: str):
         return
 
     book = pascal_case(str.strip(book))
-    if (await book_id_by_name(book)) is not None:
+    if (await book_id_by_name(ctx.guild_id, book)) is not None:
         await ctx.respond(f'{book} cannot be nominated for it was already chosen by the Flight.', ephemeral=True)
         return
 
@@ -341,6 +729,11 @@ async def addNomination(ctx, book: str):
                 'INSERT INTO nominations (session, name, nominee, added) VALUES (?, ?, ?, ?)',
                 (session, book, ctx.author.id, time.time()),
         )
+        await db.get().execute(
+                'INSERT INTO nomination_tallies (session, name, votes) VALUES (?, ?, 1) \
+                 ON CONFLICT (session, name) DO UPDATE SET votes = votes + 1',
+                (session, book),
+        )
         await db.get().commit()
     except aiosqlite.IntegrityError as e:
         if e.args[0] == 'UNIQUE constraint failed: nominations.session, nominations.name, nominations.nominee':
@@ -359,14 +752,12 @@ async def drawNominees(
   min_nominations: Option(int, "Minimum of times the book received a nomination in the session search period.", min_value=1, default=2),
   past_sessions: Option(int, "How many prior sessions should be considered in the search.", min_value=0, default=0)):
     async with db.get().execute(
-            'SELECT name, \
-                count(nominee) AS elections \
-             FROM nominations \
-             WHERE session in (select id from sessions where guild = ? order by startedAt desc limit ?) \
+            f'SELECT name, sum(votes) AS elections \
+             FROM ({TALLIES_QUERY}) \
              GROUP BY name \
-             having elections >= ? \
+             HAVING elections >= ? \
              ORDER BY elections DESC;',
-             (ctx.guild_id, past_sessions + 1 ,min_nominations,),
+             (ctx.guild_id, past_sessions + 1, min_nominations,),
              ) as cur:
         results = await cur.fetchall()
     if not results:
@@ -388,9 +779,8 @@ async def drawNominees(
 @guild_only()
 async def listNominations(ctx, past_sessions: Option(int, "How many prior sessions should be considered in the search.", min_value=0, max_value=5, default=0)):
     async with db.get().execute(
-            'SELECT name, count(nominee) AS elections  \
-            FROM nominations \
-            WHERE session IN (select id from sessions where guild = ? order by startedAt desc limit ?) \
+            f'SELECT name, sum(votes) AS elections \
+            FROM ({TALLIES_QUERY}) \
             GROUP BY name \
             ORDER BY name asc;',
              (ctx.guild_id, past_sessions + 1),
@@ -484,10 +874,32 @@ async def easter_egg(message: discord.message):
     random_emoji = emoji_list[random.randint(0, emoji_list.__len__()-1)]
     await message.add_reaction(random_emoji)
 
+async def cached_embed(book_url, build):
+    # Link previews are stored as the embed's serialized payload, so reposts
+    # neither scrape nor rebuild anything
+    async with db.get().execute(
+            'SELECT payload FROM link_previews WHERE url=? AND version=? AND fetched>?',
+            (book_url, EMBED_VERSION, time.time() - preview_ttl),
+            ) as cur:
+        result = await cur.fetchone()
+    if result is not None:
+        return discord.Embed.from_dict(json.loads(result[0]))
+
+    embed = await build(book_url)
+    if embed:
+        # Expired previews go as new ones come in, or the table would only grow
+        await db.get().execute('DELETE FROM link_previews WHERE fetched < ?', (time.time() - preview_ttl,))
+        await db.get().execute(
+                'INSERT OR REPLACE INTO link_previews (url, version, payload, fetched) VALUES (?, ?, ?, ?)',
+                (book_url, EMBED_VERSION, json.dumps(embed.to_dict()), time.time()),
+        )
+        await db.get().commit()
+    return embed
+
 async def royalroad_embed(message: discord.message):
   if message.content.startswith(("https://www.royalroad.com/fiction/", "https://royalroad.com/fiction/")) :
         book_url = message.content.split()[0]
-        embed = await getRoyalRoadBook("/".join(book_url.split('/')[:6])) #fixes the url format
+        embed = await cached_embed("/".join(book_url.split('/')[:6]), getRoyalRoadBook) #fixes the url format
         if embed:
             await message.channel.send(embed=embed, reference=message.to_reference())
             await message.edit(suppress = True)
@@ -495,12 +907,82 @@ async def royalroad_embed(message: discord.message):
 async def goodreads_embed(message: discord.message):
   if message.content.startswith(("https://www.goodreads.com/book/show/", "https://goodreads.com/book/show/")) :
         book_url = message.content.split()[0]
-        embed = await getGoodreadsBook(book_url)
+        embed = await cached_embed(book_url, getGoodreadsBook)
         if embed:
             await message.channel.send(embed=embed, reference=message.to_reference())
             await message.edit(suppress = True)
 
 
+async def owner_only(ctx):
+    # For diagnostics covering the whole bot rather than one guild; the
+    # default permissions already keep these out of most members' menus
+    if await bot.is_owner(ctx.author):
+        return True
+    await ctx.respond('Only the bot\'s owner can see this.', ephemeral=True)
+    return False
+
+@bot.slash_command(name="maintenance", description="See how the bot's database upkeep is doing")
+@guild_only()
+@default_permissions(manage_messages=True)
+async def maintenanceStats(ctx):
+    if not await owner_only(ctx):
+        return
+
+    pagination = into_paginated_embed([(task,) for task in maintainer.tasks],
+        lambda _: discord.Embed(
+            title='Database maintenance',
+            description=f'{len(maintainer.tasks)} scheduled tasks.',
+        ),
+        lambda embed, task: \
+                embed.add_field(
+                    name=task.name,
+                    value=f'Runs: {task.runs} ({task.failures} failed)\n'
+                        + (f'Last: <t:{round(task.last_run)}:R> in {task.last_duration:.3f}s\n' if task.runs else '')
+                        + f'Max: {task.max_duration:.3f}s, total: {task.total_duration:.3f}s\n'
+                        + f'Next: <t:{round(task.due)}:R>',
+                    inline=False,
+                ),
+    )
+    await pagination.respond(ctx.interaction, ephemeral=True)
+
+@bot.slash_command(name="loop-health", description="See whether anything has been holding up the bot")
+@guild_only()
+@default_permissions(manage_messages=True)
+async def loopHealth(ctx):
+    if not await owner_only(ctx):
+        return
+
+    lag = f'Event loop lag: {loop_watchdog.percentile(50) * 1000:.1f}ms median, ' \
+        + f'{loop_watchdog.percentile(99) * 1000:.1f}ms p99, {max(loop_watchdog.lags, default=0) * 1000:.1f}ms max'
+    stalls = list(reversed(loop_watchdog.stalls))
+    if not stalls:
+        await ctx.respond(lag + '\nNo stalls recorded.', ephemeral=True)
+        return
+
+    pagination = into_paginated_embed([(stall,) for stall in stalls],
+        lambda _: discord.Embed(
+            title='Event loop stalls',
+            description=lag,
+        ),
+        lambda embed, stall: \
+                embed.add_field(
+                    name=f'{stall.handler} blocked for {stall.duration:.3f}s',
+                    value=f'<t:{round(stall.started)}:R>\n```{stall.stack[-1].strip()[:900]}```',
+                    inline=False,
+                ),
+    )
+    await pagination.respond(ctx.interaction, ephemeral=True)
+
+def watch_handlers():
+    # What a stall can be blamed on; see lib/watchdog.py
+    handlers = {command.callback.__code__: f'/{command.name}' for command in bot.pending_application_commands}
+    handlers[on_message.__code__] = 'on_message'
+    return handlers
+
+@bot.listen()
+async def on_application_command(ctx):
+    maintainer.touch()
+
 @bot.event
 async def on_ready():
     await bot.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name="dragons!"))
@@ -511,58 +993,128 @@ async def on_message(message: discord.message):
     if message.author == bot.user:
         return
 
+    maintainer.touch()
+
     await goodreads_embed(message)
     await royalroad_embed(message)
     await easter_egg(message)
 
+background_tasks = set()
+
+def in_background(coro, name):
+    # Nothing ever awaits these, so a crash is logged as soon as it happens
+    # rather than being noticed (if at all) at shutdown
+    task = asyncio.create_task(coro, name=name)
+    background_tasks.add(task)
+    task.add_done_callback(background_done)
+    return task
+
+def background_done(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        log.error('Background task %s crashed', task.get_name(), exc_info=task.exception())
+
+async def setup_database():
+    await db.get().executescript('''
+        PRAGMA foreign_keys = ON;
+        -- Only takes on new databases, see the readme for older ones
+        PRAGMA auto_vacuum = INCREMENTAL;
+        PRAGMA journal_mode = WAL;
+
+        CREATE TABLE IF NOT EXISTS books (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild INTEGER,
+            added REAL,
+            addedBy INTEGER,
+            name TEXT,
+            UNIQUE (guild, name)
+        );
+        CREATE INDEX IF NOT EXISTS books_idx_guild ON books (guild);
+        CREATE INDEX IF NOT EXISTS books_idx_name ON books (name);
+        CREATE TABLE IF NOT EXISTS books_readers (
+            book INTEGER REFERENCES books(id) ON UPDATE CASCADE ON DELETE CASCADE,
+            reader INTEGER,
+            added REAL,
+            UNIQUE (book, reader)
+        );
+        CREATE INDEX IF NOT EXISTS books_readers_idx_reader ON books_readers (reader);
+
+        CREATE TABLE IF NOT EXISTS sessions (
+            id INTEGER PRIMARY KEY,
+            guild INTEGER,
+            startedBy INTEGER,
+            startedAt REAL,
+            ended INTEGER DEFAULT 0,
+            endedBy INTEGER,
+            endedAt REAL
+        );
+        CREATE INDEX IF NOT EXISTS sessions_idx_guild ON sessions (guild);
+
+        CREATE TABLE IF NOT EXISTS nominations(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session INTEGER REFERENCES sessions(id) ON UPDATE CASCADE ON DELETE CASCADE,
+            name TEXT,
+            nominee INTEGER,
+            added REAL,
+            UNIQUE (session, name, nominee)
+        );
+        CREATE INDEX IF NOT EXISTS nominations_idx_session ON nominations(session);
+        CREATE INDEX IF NOT EXISTS nominations_idx_name ON nominations(name);
+        CREATE INDEX IF NOT EXISTS nominations_idx_nominee ON nominations(nominee);
+
+        CREATE INDEX IF NOT EXISTS sessions_idx_guild_startedAt ON sessions (guild, startedAt);
+
+        CREATE TABLE IF NOT EXISTS nomination_tallies(
+            session INTEGER REFERENCES sessions(id) ON UPDATE CASCADE ON DELETE CASCADE,
+            name TEXT,
+            votes INTEGER,
+            PRIMARY KEY (session, name)
+        );
+
+        CREATE TABLE IF NOT EXISTS nomination_archive(
+            session INTEGER REFERENCES sessions(id) ON UPDATE CASCADE ON DELETE CASCADE,
+            name TEXT,
+            votes INTEGER,
+            PRIMARY KEY (session, name)
+        );
+
+        CREATE TABLE IF NOT EXISTS link_previews(
+            url TEXT,
+            version INTEGER,
+            payload TEXT,
+            fetched REAL,
+            PRIMARY KEY (url, version)
+        );
+        CREATE INDEX IF NOT EXISTS link_previews_idx_fetched ON link_previews (fetched);
+    ''')
+    # Previews from older templates will never be read again
+    await db.get().execute('DELETE FROM link_previews WHERE version != ? OR fetched < ?', (EMBED_VERSION, time.time() - preview_ttl))
+    await db.get().executescript(activity.SCHEMA)
+    await db.get().executescript(enrichment.SCHEMA)
+    await backfill_nomination_tallies()
+    await db.get().commit()
+
 async def main():
     async with aiosqlite.connect(os.environ['SQLITE3_DATABASE']) as _db:
         db.set(_db)
-        await db.get().executescript('''
-            PRAGMA foreign_keys = ON;
-
-            CREATE TABLE IF NOT EXISTS books (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                guild INTEGER,
-                added REAL,
-                addedBy INTEGER,
-                name TEXT,
-                UNIQUE (guild, name)
-            );
-            CREATE INDEX IF NOT EXISTS books_idx_guild ON books (guild);
-            CREATE INDEX IF NOT EXISTS books_idx_name ON books (name);
-            CREATE TABLE IF NOT EXISTS books_readers (
-                book INTEGER REFERENCES books(id) ON UPDATE CASCADE ON DELETE CASCADE,
-                reader INTEGER,
-                added REAL,
-                UNIQUE (book, reader)
-            );
-
-            CREATE TABLE IF NOT EXISTS sessions (
-                id INTEGER PRIMARY KEY,
-                guild INTEGER,
-                startedBy INTEGER,
-                startedAt REAL,
-                ended INTEGER DEFAULT 0,
-                endedBy INTEGER,
-                endedAt REAL
-            );
-            CREATE INDEX IF NOT EXISTS sessions_idx_guild ON sessions (guild);
-
-            CREATE TABLE IF NOT EXISTS nominations(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session INTEGER REFERENCES sessions(id) ON UPDATE CASCADE ON DELETE CASCADE,
-                name TEXT,
-                nominee INTEGER,
-                added REAL,
-                UNIQUE (session, name, nominee)
-            );
-            CREATE INDEX IF NOT EXISTS nominations_idx_session ON nominations(session);
-            CREATE INDEX IF NOT EXISTS nominations_idx_name ON nominations(name);
-            CREATE INDEX IF NOT EXISTS nominations_idx_nominee ON nominations(nominee);
-        ''')
-        await db.get().commit()
-        await bot.start(os.environ['TOKEN'])
+        await setup_database()
+        loop_watchdog.handlers = watch_handlers()
+        in_background(loop_watchdog.run(), 'watchdog')
+        in_background(activity.backfill(db.get(), chunk=int(os.environ.get('ROLLUP_BACKFILL_CHUNK', 5000))), 'rollup-backfill')
+        if os.environ['SQLITE3_DATABASE'] != ':memory:':
+            in_background(maintainer.run(), 'maintenance')
+        if os.environ.get('ENRICH_BOOKS', '').lower() in ('1', 'true', 'yes'):
+            crawler = enrichment.Crawler(
+                db.get(),
+                concurrency=int(os.environ.get('ENRICH_CONCURRENCY', 2)),
+                delay=float(os.environ.get('ENRICH_DELAY', 2)),
+            )
+            in_background(crawler.run(), 'enrichment')
+        try:
+            await bot.start(os.environ['TOKEN'])
+        finally:
+            # Recommended before closing; it only analyzes what this run queried
+            await db.get().execute('PRAGMA optimize')
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,302 @@
+'''
+Drives the bot's commands without Discord.
+
+Fake interactions and messages are fired at the real command coroutines,
+backed by a throwaway SQLite database; link previews are scraped from a local
+stand-in for Goodreads and Royal Road. Throughput, per-command latencies,
+event loop lag and any stalls the bot's watchdog caught are printed at the
+end, so changes to caching or concurrency can be compared before and after.
+
+Nothing here talks to Discord, so no TOKEN is needed.
+'''
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+import aiosqlite
+import discord
+from aiohttp import web
+
+parser = argparse.ArgumentParser(description='Load test the bot with simulated interactions')
+parser.add_argument('--operations', type=int, default=5000, help='Total number of commands and messages to fire')
+parser.add_argument('--concurrency', type=int, default=200, help='How many of them are in flight at once')
+parser.add_argument('--guilds', type=int, default=10, help='Number of simulated guilds')
+parser.add_argument('--users', type=int, default=500, help='Number of simulated users, shared between guilds')
+parser.add_argument('--books', type=int, default=200, help='Books added to each guild before the run')
+parser.add_argument('--seed', type=int, default=None, help='Seed for the random workload, for repeatable runs')
+parser.add_argument('--keep-database', action='store_true', help='Leave the temporary database behind and print its path')
+
+# Just enough markup for the scrapers in lib/ to find everything they look for
+GOODREADS_PAGE = '''<html><head>
+<title>Book {id} by Author {id}</title>
+<meta property="og:image" content="https://example.com/{id}.jpg">
+</head><body>
+<div class="BookPageTitleSection__title">
+  <h3><a href="https://www.goodreads.com/series/{id}">Series {id}</a></h3>
+  <h1>Book {id}</h1>
+</div>
+<div class="ContributorLinksList">
+  <a href="https://www.goodreads.com/author/show/{id}"><span class="ContributorLink__name">Author {id}</span></a>
+  <a href="https://www.goodreads.com/author/show/{id}0"><span class="ContributorLink__name">Translator {id}</span></a>
+</div>
+<div class="BookPageMetadataSection__description"><span>{description}</span></div>
+<div class="RatingStatistics__rating">4.2</div>
+</body></html>'''
+
+ROYALROAD_PAGE = '''<html><head>
+<title>Fiction {id} | Royal Road</title>
+<meta property="og:image" content="/covers/{id}.jpg">
+<meta property="og:description" content="{description}">
+<meta property="books:author" content="Author {id}">
+<meta property="books:rating:value" content="4.56">
+</head><body>
+<div class="fic-title"><h1>Fiction {id}</h1><a href="/profile/{id}">Author {id}</a></div>
+<div class="portlet-body"><img src="/avatars/{id}.png"></div>
+<div class="fiction-info">
+  <span class="label">{id} Chapters</span>
+  <span class="tags"><a href="/tags/fantasy">Fantasy</a><a href="/tags/dragons">Dragons</a></span>
+</div>
+<div class="stats-content"><ul>
+  <li class="font-red-sunglo">1</li><li class="font-red-sunglo">2</li><li class="font-red-sunglo">300</li>
+  <li class="font-red-sunglo">40</li><li class="font-red-sunglo">5</li><li class="font-red-sunglo">600</li>
+</ul></div>
+</body></html>'''
+
+DESCRIPTION = 'Dragons hoard books. ' * 40
+
+async def stub_sites():
+    async def goodreads_page(request):
+        return web.Response(text=GOODREADS_PAGE.format(id=request.match_info['id'], description=DESCRIPTION), content_type='text/html')
+
+    async def royalroad_page(request):
+        return web.Response(text=ROYALROAD_PAGE.format(id=request.match_info['id'], description=DESCRIPTION), content_type='text/html')
+
+    app = web.Application()
+    app.router.add_get('/book/show/{id}', goodreads_page)
+    app.router.add_get('/fiction/{id}/{slug}', royalroad_page)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port = site._server.sockets[0].getsockname()[:2]
+    return runner, f'http://{host}:{port}'
+
+def redirect_scraper(module, base):
+    # The bot only previews links to the real sites; point the scrapers at the
+    # stub instead, keeping the path
+    getBook = module.getBook
+
+    async def getStubBook(book_url):
+        return await getBook(base + '/' + book_url.split('/', 3)[3])
+
+    module.getBook = getStubBook
+
+class FakeUser:
+    def __init__(self, id):
+        self.id = id
+        self.name = f'user{id}'
+        self.mention = f'<@{id}>'
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    def is_done(self):
+        return bool(self.interaction.sent)
+
+    async def send_message(self, content=None, **kwargs):
+        self.interaction.sent.append((content, kwargs))
+
+class FakeInteraction(discord.Interaction):
+    # The paginator insists on a real Interaction, but only ever uses its
+    # user and response
+    __slots__ = ('sent', '_fake_response')
+
+    def __init__(self, user):
+        self.user = user
+        self.sent = []
+        self._fake_response = FakeResponse(self)
+
+    @property
+    def response(self):
+        return self._fake_response
+
+class FakeContext:
+    def __init__(self, guild_id, user):
+        self.guild_id = guild_id
+        self.author = user
+        self.interaction = FakeInteraction(user)
+
+    async def respond(self, content=None, **kwargs):
+        self.interaction.sent.append((content, kwargs))
+
+class FakeChannel:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append((content, kwargs))
+
+class FakeMessage:
+    def __init__(self, content, user):
+        self.content = content
+        self.author = user
+        self.channel = FakeChannel()
+        self.reactions = []
+
+    def to_reference(self):
+        return None
+
+    async def edit(self, **kwargs):
+        pass
+
+    async def add_reaction(self, emoji):
+        self.reactions.append(emoji)
+
+async def watch_loop(lags, interval=0.01):
+    # How late a short sleep wakes up is how long something else held the loop
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+def report(name, samples):
+    if not samples:
+        return
+    print('{:<12} {:>7} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+        name, len(samples),
+        statistics.mean(samples) * 1000,
+        percentile(samples, 50) * 1000,
+        percentile(samples, 95) * 1000,
+        percentile(samples, 99) * 1000,
+        max(samples) * 1000,
+    ))
+
+async def run(args, librarycard):
+    rng = random.Random(args.seed)
+    guilds = [1000 + g for g in range(args.guilds)]
+    users = [FakeUser(2000 + u) for u in range(args.users)]
+    library = {guild: [f'Book {guild}-{b}' for b in range(args.books)] for guild in guilds}
+    added = {guild: args.books for guild in guilds}
+
+    print('Seeding guilds...')
+    for guild in guilds:
+        for title in library[guild]:
+            await librarycard.addBook.callback(FakeContext(guild, users[0]), title)
+        await librarycard.startSession.callback(FakeContext(guild, users[0]))
+
+    def add_book():
+        guild = rng.choice(guilds)
+        added[guild] += 1
+        title = f'Book {guild}-{added[guild]}'
+        library[guild].append(title)
+        return librarycard.addBook.callback(FakeContext(guild, users[0]), title)
+
+    def read_book():
+        guild = rng.choice(guilds)
+        return librarycard.readBook.callback(FakeContext(guild, rng.choice(users)), rng.choice(library[guild]))
+
+    def nominate():
+        guild = rng.choice(guilds)
+        return librarycard.addNomination.callback(FakeContext(guild, rng.choice(users)), f'Nominee {rng.randrange(50)}')
+
+    def list_library():
+        return librarycard.library.callback(FakeContext(rng.choice(guilds), rng.choice(users)))
+
+    def post_link():
+        if rng.random() < 0.5:
+            url = f'https://www.goodreads.com/book/show/{rng.randrange(100)}'
+        else:
+            url = f'https://www.royalroad.com/fiction/{rng.randrange(100)}/some-fiction'
+        return librarycard.on_message(FakeMessage(url, rng.choice(users)))
+
+    workload = [
+        ('addbook', add_book, 1),
+        ('readbook', read_book, 6),
+        ('nominate', nominate, 3),
+        ('library', list_library, 2),
+        ('on_message', post_link, 2),
+    ]
+    names, makers, weights = zip(*workload)
+    latencies = {name: [] for name in names}
+    failures = {name: 0 for name in names}
+    plan = rng.choices(range(len(workload)), weights=weights, k=args.operations)
+
+    async def worker(queue):
+        while queue:
+            op = queue.pop()
+            started = time.perf_counter()
+            try:
+                await makers[op]()
+            except Exception as e:
+                failures[names[op]] += 1
+                if failures[names[op]] == 1:
+                    print(f'{names[op]} failed: {e!r}')
+            latencies[names[op]].append(time.perf_counter() - started)
+
+    print(f'Firing {args.operations} operations, {args.concurrency} at a time...')
+    lags = []
+    watcher = asyncio.create_task(watch_loop(lags))
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(plan) for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    watcher.cancel()
+
+    print()
+    print(f'{args.operations} operations in {elapsed:.2f}s: {args.operations / elapsed:.1f} ops/s')
+    print()
+    print('{:<12} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}'.format('ms', 'count', 'mean', 'p50', 'p95', 'p99', 'max'))
+    for name in names:
+        report(name, latencies[name])
+    report('loop lag', lags)
+    if any(failures.values()):
+        print()
+        print('Failures: ' + ', '.join(f'{name} {count}' for name, count in failures.items() if count))
+
+    stalls = {}
+    for stall in librarycard.loop_watchdog.stalls:
+        stalls.setdefault(stall.handler, []).append(stall.duration)
+    if stalls:
+        print()
+        print(f'Stalls over {librarycard.loop_watchdog.threshold * 1000:.0f}ms: '
+            + ', '.join(f'{handler} {len(durations)} (max {max(durations) * 1000:.0f}ms)' for handler, durations in stalls.items()))
+
+async def main(args):
+    path = os.path.join(tempfile.mkdtemp(prefix='librarycard-load-'), 'db.sqlite3')
+    os.environ['SQLITE3_DATABASE'] = path
+    os.environ.setdefault('EASTER_EGG_CHANCE', '0')
+    os.environ.setdefault('EASTER_EGG_EMOJI_LIST', ':dragon:')
+
+    # Imported late so the bot picks up the environment above
+    import librarycard
+
+    runner, base = await stub_sites()
+    redirect_scraper(librarycard.goodreads, base)
+    redirect_scraper(librarycard.royalroad, base)
+    try:
+        async with aiosqlite.connect(path) as db:
+            librarycard.db.set(db)
+            await librarycard.setup_database()
+            librarycard.loop_watchdog.handlers = librarycard.watch_handlers()
+            librarycard.in_background(librarycard.loop_watchdog.run(), 'watchdog')
+            await run(args, librarycard)
+    finally:
+        await runner.cleanup()
+        if args.keep_database:
+            print(f'Database left at {path}')
+        else:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+            os.rmdir(os.path.dirname(path))
+
+if __name__ == '__main__':
+    asyncio.run(main(parser.parse_args()))